@@ -2,11 +2,17 @@ import streamlit as st
 import pandas as pd
 import sqlite3
 import hashlib
+import hmac
 import json
 import re
+import secrets
 import requests
 import smtplib
+import string
+import time
 from email.message import EmailMessage
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
 from io import BytesIO, StringIO
 
@@ -35,12 +41,15 @@ COMPANY_NAME = "HGHI Tech"
 OWNER_NAME = "Darrell Kelly"
 SUPERVISORS = ["Brandon Alves", "Andre Ampey"]
 
+PRIORITIES = ["normal", "high", "urgent"]
+PRIORITY_IDX = {p: i for i, p in enumerate(PRIORITIES)}
+
 st.set_page_config(page_title=APP_NAME, page_icon="🏗️", layout="wide")
 
 # =========================================================
 # UI STYLE
 # =========================================================
-st.markdown("""
+APP_CSS = """
 <style>
 .header {
   background: linear-gradient(135deg, #1e40af 0%, #3b82f6 100%);
@@ -70,7 +79,30 @@ st.markdown("""
 .small { font-size: 0.9rem; }
 hr { border: none; border-top: 1px solid #e5e7eb; margin: 14px 0; }
 </style>
-""", unsafe_allow_html=True)
+"""
+# Re-sent every rerun on purpose: elements not re-rendered are dropped from the page.
+st.markdown(APP_CSS, unsafe_allow_html=True)
+
+# Title/subtitle card used by the building and unit-report headers
+TITLE_CARD = string.Template("<div class='card'><b>$title</b><div class='muted'>$subtitle</div></div>")
+
+# Blue page header (login + dashboard)
+HEADER_CARD = string.Template("""
+    <div class="header">
+      <h2 style="margin:0;">$title</h2>
+      <div class="muted">$subtitle</div>
+    </div>
+    """)
+LOGIN_HEADER = HEADER_CARD.substitute(title=f"🏢 {COMPANY_NAME}", subtitle=APP_NAME)
+
+# Sidebar user card
+USER_CARD = string.Template("""
+        <div class="card">
+          <div style="font-weight:800; font-size:1.05rem;">👤 $name</div>
+          <div style="margin-top:6px;">$badge</div>
+          <div class="muted" style="margin-top:6px;">$email</div>
+        </div>
+        """)
 
 # =========================================================
 # SESSION STATE (safe defaults)
@@ -79,6 +111,10 @@ def ss_setdefault(key, value):
     if key not in st.session_state:
         st.session_state[key] = value
 
+def ss_set(key, value):
+    # For on_click callbacks (state is updated before the rerun, no st.rerun needed)
+    st.session_state[key] = value
+
 ss_setdefault("logged_in", False)
 ss_setdefault("user", None)
 ss_setdefault("current_page", "Dashboard")
@@ -90,17 +126,54 @@ ss_setdefault("active_time_entry_id", None)
 # DATABASE
 # =========================================================
 def db():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+    """
+    One connection per browser session, kept in session_state: every rerun
+    runs on a fresh script thread, but a session's runs never overlap, so
+    the connection is reused across them (hence check_same_thread=False).
+    Sessions never share a connection, so their transactions stay separate
+    and SQLite/WAL handles the concurrency. WAL itself is a property of the
+    database file and is set once in init_db().
+    """
+    conn = st.session_state.get("_db_conn")
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA cache_size=-20000")
+        st.session_state["_db_conn"] = conn
+    return conn
+
+def query_dicts(sql: str, params=()) -> list:
+    """
+    Small result sets as a list of dicts (no DataFrame construction).
+    """
+    c = db().cursor()
+    c.row_factory = sqlite3.Row
+    c.execute(sql, params)
+    return [dict(r) for r in c.fetchall()]
+
+DB_TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def now_str() -> str:
+    """
+    Current UTC time in the TEXT format stored in every *_at / clock column.
+    """
+    return time.strftime(DB_TS_FORMAT, time.gmtime())
 
 def init_db():
     conn = db()
     c = conn.cursor()
 
+    # Persistent (stored in the database file), so once per process is enough
+    c.execute("PRAGMA journal_mode=WAL")
+
     c.execute("""
     CREATE TABLE IF NOT EXISTS contractors (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT NOT NULL,
-        email TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE NOT NULL COLLATE NOCASE,
         password_hash TEXT NOT NULL,
         role TEXT NOT NULL,
         status TEXT NOT NULL DEFAULT 'active',
@@ -205,11 +278,45 @@ def init_db():
     )
     """)
 
+    # Successful DeepSeek results keyed by sha256 of the request (see ai_cache_get)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS ai_cache (
+        key TEXT PRIMARY KEY,
+        result TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    """)
+
+    # Indexes for the per-unit lookups run on every Buildings/Unit Reports render
+    # (units(building_id) is already covered by its UNIQUE(building_id, unit_number)).
+    c.execute("CREATE INDEX IF NOT EXISTS idx_equipment_unit ON equipment(unit_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_unit_logs_unit ON unit_logs(unit_id, building_id, created_at)")
+    # Open-shift probe in clock_in/clock_out: contractor_id=? AND clock_out IS NULL
+    c.execute("CREATE INDEX IF NOT EXISTS idx_time_entries_open ON time_entries(contractor_id, clock_out)")
+
     conn.commit()
-    conn.close()
+
+PBKDF2_ITERATIONS = 200_000
 
 def hash_password(pw: str) -> str:
-    return hashlib.sha256(pw.encode("utf-8")).hexdigest()
+    """
+    Salted PBKDF2-SHA256, stored as pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>.
+    """
+    salt = secrets.token_bytes(16)
+    dk = hashlib.pbkdf2_hmac("sha256", pw.encode("utf-8"), salt, PBKDF2_ITERATIONS)
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${salt.hex()}${dk.hex()}"
+
+def check_password(pw: str, stored: str) -> bool:
+    if stored.startswith("pbkdf2_sha256$"):
+        _, iterations, salt, expected = stored.split("$")
+        dk = hashlib.pbkdf2_hmac("sha256", pw.encode("utf-8"), bytes.fromhex(salt), int(iterations))
+        return hmac.compare_digest(dk.hex(), expected)
+    # Legacy unsalted SHA-256 (rehashed on next successful login)
+    return hmac.compare_digest(hashlib.sha256(pw.encode("utf-8")).hexdigest(), stored)
+
+# Checked against when the email is unknown, so a miss costs the same PBKDF2
+# time as a wrong password and login timing doesn't reveal which accounts exist
+DUMMY_PASSWORD_HASH = f"pbkdf2_sha256${PBKDF2_ITERATIONS}${'00' * 16}${'00' * 32}"
 
 def upsert_default_users():
     """
@@ -232,32 +339,85 @@ def upsert_default_users():
 
     conn = db()
     c = conn.cursor()
-    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-
-    for name, email, pw, role, status, rate in defaults:
-        c.execute("SELECT id FROM contractors WHERE email=?", (email,))
-        row = c.fetchone()
-        if row:
-            c.execute("""
-                UPDATE contractors
-                SET name=?, role=?, status=?, hourly_rate=?
-                WHERE email=?
-            """, (name, role, status, rate, email))
-        else:
-            c.execute("""
-                INSERT INTO contractors (name,email,password_hash,role,status,hourly_rate,created_at)
-                VALUES (?,?,?,?,?,?,?)
-            """, (name, email, hash_password(pw), role, status, rate, now))
-
-    conn.commit()
-    conn.close()
+    now = now_str()
+
+    with conn:
+        existing = {r[0] for r in c.execute("SELECT email FROM contractors")}
+        c.executemany("""
+            UPDATE contractors
+            SET name=?, role=?, status=?, hourly_rate=?
+            WHERE email=?
+        """, [(name, role, status, rate, email)
+              for name, email, pw, role, status, rate in defaults if email in existing])
+        c.executemany("""
+            INSERT INTO contractors (name,email,password_hash,role,status,hourly_rate,created_at)
+            VALUES (?,?,?,?,?,?,?)
+        """, [(name, email, hash_password(pw), role, status, rate, now)
+              for name, email, pw, role, status, rate in defaults if email not in existing])
+
+@st.cache_resource
+def init_once():
+    """
+    Schema + default users once per server process, not on every rerun.
+    """
+    init_db()
+    upsert_default_users()
+    return True
 
-init_db()
-upsert_default_users()
+init_once()
 
 # =========================================================
 # AI (DeepSeek)
 # =========================================================
+@st.cache_resource
+def http():
+    """
+    One keep-alive session per server process; auth headers are set once here.
+    """
+    sess = requests.Session()
+    # Small pool, short retries: transient 429/5xx and failed connects get
+    # two quick retries (POST included); no long Retry-After sleeps in the UI.
+    # read=0: a POST the server already accepted (e.g. a slow completion that
+    # hit the read timeout) is never re-sent and billed again.
+    retry = Retry(
+        total=2,
+        read=0,
+        backoff_factor=0.2,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=["POST"],
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retry)
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    sess.headers.update({
+        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+        "Content-Type": "application/json",
+    })
+    return sess
+
+def ai_cache_key(kind: str, text: str) -> str:
+    return hashlib.sha256(f"{kind}:{text}".encode("utf-8")).hexdigest()
+
+def ai_cache_get(key: str):
+    row = db().execute("SELECT result FROM ai_cache WHERE key=?", (key,)).fetchone()
+    return row[0] if row else None
+
+# Newest rows kept in ai_cache; older ones are pruned on insert
+AI_CACHE_MAX_ROWS = 256
+
+def ai_cache_put(key: str, result: str):
+    conn = db()
+    now = now_str()
+    with conn:
+        # INSERT OR REPLACE re-inserts, so rowid order is write order
+        conn.execute("INSERT OR REPLACE INTO ai_cache (key, result, created_at) VALUES (?,?,?)", (key, result, now))
+        conn.execute("""
+            DELETE FROM ai_cache
+            WHERE rowid NOT IN (SELECT rowid FROM ai_cache ORDER BY rowid DESC LIMIT ?)
+        """, (AI_CACHE_MAX_ROWS,))
+
 def deepseek_chat(messages, temperature=0.2, max_tokens=600, timeout=8):
     """
     Bullet-proof call: if anything fails, return None.
@@ -265,10 +425,6 @@ def deepseek_chat(messages, temperature=0.2, max_tokens=600, timeout=8):
     if not DEEPSEEK_API_KEY:
         return None
 
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json",
-    }
     payload = {
         "model": "deepseek-chat",
         "messages": messages,
@@ -276,7 +432,7 @@ def deepseek_chat(messages, temperature=0.2, max_tokens=600, timeout=8):
         "max_tokens": max_tokens,
     }
     try:
-        r = requests.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=timeout)
+        r = http().post(DEEPSEEK_API_URL, json=payload, timeout=timeout)
         if r.status_code == 200:
             data = r.json()
             return data["choices"][0]["message"]["content"]
@@ -284,50 +440,136 @@ def deepseek_chat(messages, temperature=0.2, max_tokens=600, timeout=8):
     except Exception:
         return None
 
+def deepseek_chat_stream(messages, temperature=0.2, max_tokens=600, timeout=8, status=None):
+    """
+    Streaming variant of deepseek_chat: yields content chunks as they arrive.
+    Yields nothing if the key is missing or the call fails; a failure mid-stream
+    just ends it, so pass a dict as `status` and check status["done"] (set only
+    once "data: [DONE]" arrives) before trusting the text as complete.
+    """
+    if not DEEPSEEK_API_KEY:
+        return
+
+    payload = {
+        "model": "deepseek-chat",
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True,
+    }
+    try:
+        with http().post(DEEPSEEK_API_URL, json=payload, timeout=timeout, stream=True) as r:
+            if r.status_code != 200:
+                return
+            # SSE is UTF-8 by spec; without a charset requests would guess ISO-8859-1
+            r.encoding = "utf-8"
+            # OpenAI-compatible SSE: "data: {...}" lines, terminated by "data: [DONE]"
+            for line in r.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    if status is not None:
+                        status["done"] = True
+                    break
+                chunk = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                if chunk:
+                    yield chunk
+    except Exception:
+        return
+
+_JSON_DECODER = json.JSONDecoder()
+
+EMAIL_PARSE_SYSTEM_PROMPT = (
+    "Parse the following work order email. Return ONLY valid JSON with keys: "
+    "ticket_id, property_code, property_name, unit_number, resident_name, priority, issue_description, notes."
+)
+# Upload caps for DeepSeek prompts (work-order emails are short; exports can be huge)
+EMAIL_PARSE_MAX_CHARS = 4000
+REPORT_NOTES_MAX_CHARS = 12000
+
+def extract_json_object(text: str):
+    """
+    First JSON object embedded in an AI reply, decoded in place with
+    raw_decode (no regex, stray braces in prose are skipped). Returns dict or None.
+    """
+    idx = text.find("{")
+    while idx != -1:
+        try:
+            obj, _ = _JSON_DECODER.raw_decode(text, idx)
+            if isinstance(obj, dict):
+                return obj
+        except json.JSONDecodeError:
+            pass
+        idx = text.find("{", idx + 1)
+    return None
+
+# Fallback email patterns, compiled once at import
+_TICKET_RE = re.compile(r"(T[-_ ]?\d{5,8})", re.IGNORECASE)
+_BRACKET_RE = re.compile(r"\[([^\[\]]*)\]")
+_PROP_CODE_RE = re.compile(r"[A-Z0-9]{4,}", re.IGNORECASE)
+_UNIT_RE = re.compile(r"[A-Z]-?\d{1,4}", re.IGNORECASE)
+_RESIDENT_RE = re.compile(r"Resident[:\s]+([A-Za-z][A-Za-z\s\.\-']+)", re.IGNORECASE)
+_ISSUE_RE = re.compile(r"Issue[:\s]+(.+)", re.IGNORECASE)
+_PRIORITY_RE = re.compile(r"urgent|asap|high", re.IGNORECASE)
+
 def parse_elauwit_email(email_text: str) -> dict:
     """
     AI first, fallback to regex.
     Returns dict with ticket_id, property_code/name, unit, resident, priority, description
     """
+    key = ai_cache_key("parse_v1", email_text)
+    hit = ai_cache_get(key)
+    if hit:
+        return json.loads(hit)
+
     # AI attempt
     ai = deepseek_chat(
         [
-            {"role": "system", "content":
-             "Parse the following work order email. Return ONLY valid JSON with keys: "
-             "ticket_id, property_code, property_name, unit_number, resident_name, priority, issue_description, notes."},
-            {"role": "user", "content": email_text}
+            {"role": "system", "content": EMAIL_PARSE_SYSTEM_PROMPT},
+            {"role": "user", "content": email_text[:EMAIL_PARSE_MAX_CHARS]}
         ],
         temperature=0.1,
         max_tokens=400,
         timeout=6
     )
     if ai:
-        m = re.search(r"\{.*\}", ai, re.DOTALL)
-        if m:
-            try:
-                return json.loads(m.group(0))
-            except Exception:
-                pass
+        parsed = extract_json_object(ai)
+        if parsed:
+            # Models answer "High"/"URGENT"/...; keep only values the form knows
+            p = parsed.get("priority")
+            p = p.strip().lower() if isinstance(p, str) else ""
+            parsed["priority"] = p if p in PRIORITY_IDX else "normal"
+            ai_cache_put(key, json.dumps(parsed))
+            return parsed
 
     # Fallback regex (never breaks demo)
     def find(pattern, default=None):
-        mm = re.search(pattern, email_text, re.IGNORECASE)
+        mm = pattern.search(email_text)
         return mm.group(1).strip() if mm else default
 
-    ticket = find(r"(T[-_ ]?\d{5,8})", None)
-    prop_code = find(r"\[([A-Z0-9]{4,})\]", None)  # first bracket token
-    unit = find(r"\[([A-Z]-?\d{1,4})\]", None)
+    ticket = find(_TICKET_RE, None)
+
+    # One pass over [bracket] tokens; first property-code and first unit win.
+    prop_code = unit = None
+    for token in _BRACKET_RE.findall(email_text):
+        if prop_code is None and _PROP_CODE_RE.fullmatch(token):
+            prop_code = token
+        if unit is None and _UNIT_RE.fullmatch(token):
+            unit = token
+        if prop_code and unit:
+            break
 
-    resident = find(r"Resident[:\s]+([A-Za-z][A-Za-z\s\.\-']+)", None)
-    issue = find(r"Issue[:\s]+(.+)", None) or email_text.strip().splitlines()[-1][:200]
+    resident = find(_RESIDENT_RE, None)
+    issue = find(_ISSUE_RE, None) or email_text.strip().splitlines()[-1][:200]
 
-    lower = email_text.lower()
-    if "urgent" in lower or "asap" in lower:
-        priority = "urgent"
-    elif "high" in lower:
+    # Single scan: any urgent/asap wins outright, otherwise high, otherwise normal.
+    priority = "normal"
+    for mm in _PRIORITY_RE.finditer(email_text):
+        if mm.group(0).lower() != "high":
+            priority = "urgent"
+            break
         priority = "high"
-    else:
-        priority = "normal"
 
     return {
         "ticket_id": ticket,
@@ -343,6 +585,7 @@ def parse_elauwit_email(email_text: str) -> dict:
 def ai_generate_unit_report(unit_context: dict, raw_text: str) -> str:
     """
     Takes unit context + raw notes/chat/email and creates a professional report.
+    Streams the AI output into the page as it arrives; returns the final Markdown.
     """
     prompt = f"""
 You are HGHI Tech's operations reporting assistant.
@@ -352,7 +595,7 @@ Unit Context (JSON):
 {json.dumps(unit_context, indent=2)}
 
 Raw Field Notes / Chat / Email:
-{raw_text}
+{raw_text[:REPORT_NOTES_MAX_CHARS]}
 
 Report requirements:
 - Title line: "Unit Service Report"
@@ -365,11 +608,22 @@ Report requirements:
 - Next actions (if any)
 Return in clean Markdown.
 """
-    out = deepseek_chat([{"role": "user", "content": prompt}], temperature=0.2, max_tokens=700, timeout=10)
+    # Same prompt (context + notes) -> same report; skip DeepSeek on repeat clicks
+    key = ai_cache_key("report_v1", prompt)
+    hit = ai_cache_get(key)
+    if hit:
+        st.markdown(hit)
+        return hit
+
+    status = {}
+    out = st.write_stream(deepseek_chat_stream([{"role": "user", "content": prompt}], temperature=0.2, max_tokens=700, timeout=10, status=status))
     if out:
-        return out.strip()
+        out = out.strip()
+        if status.get("done"):
+            ai_cache_put(key, out)  # never cache a stream cut off mid-report
+        return out
     # Fallback: simple
-    return f"""# Unit Service Report
+    report = f"""# Unit Service Report
 
 **Generated:** {datetime.now().strftime('%Y-%m-%d %H:%M')}
 
@@ -380,32 +634,45 @@ Return in clean Markdown.
 - Verify service quality and confirm resident connectivity.
 - Record any equipment serial numbers in the unit equipment section.
 """
+    st.markdown(report)
+    return report
 
 # =========================================================
 # AUTH
 # =========================================================
 def verify_login(email: str, password: str):
+    """
+    Returns (user, open_time_entry_id, msg); the open clock-in (if any)
+    comes back with the user row so login needs a single query.
+    """
     conn = db()
     c = conn.cursor()
+    c.row_factory = sqlite3.Row
     c.execute("""
-        SELECT id, name, email, role, status, hourly_rate
-        FROM contractors
-        WHERE email=? AND password_hash=?
-    """, (email.strip().lower(), hash_password(password)))
+        SELECT c.id, c.name, c.email, c.role, c.status, c.hourly_rate, c.password_hash,
+               te.id AS open_entry_id
+        FROM contractors c
+        LEFT JOIN time_entries te ON te.contractor_id=c.id AND te.clock_out IS NULL
+        WHERE c.email=?
+        ORDER BY te.id DESC
+        LIMIT 1
+    """, (email.strip().lower(),))
     row = c.fetchone()
-    conn.close()
     if not row:
-        return None, "Invalid email or password."
-    if row[4] != "active":
-        return None, f"Account status is '{row[4]}'. Contact supervisor."
-    return {
-        "id": row[0],
-        "name": row[1],
-        "email": row[2],
-        "role": row[3],
-        "status": row[4],
-        "hourly_rate": float(row[5])
-    }, "OK"
+        check_password(password, DUMMY_PASSWORD_HASH)
+        return None, None, "Invalid email or password."
+    if not check_password(password, row["password_hash"]):
+        return None, None, "Invalid email or password."
+    if row["status"] != "active":
+        return None, None, f"Account status is '{row['status']}'. Contact supervisor."
+    if not row["password_hash"].startswith("pbkdf2_sha256$"):
+        with conn:
+            conn.execute("UPDATE contractors SET password_hash=? WHERE id=?", (hash_password(password), row["id"]))
+    user = dict(row)
+    del user["password_hash"]
+    open_entry_id = user.pop("open_entry_id")
+    user["hourly_rate"] = float(user["hourly_rate"])
+    return user, open_entry_id, "OK"
 
 def role_badge(role: str):
     cls = role if role in ("owner", "supervisor", "technician", "admin") else "pending"
@@ -463,97 +730,138 @@ def import_buildings_units_from_csv(file_bytes: bytes):
 
     conn = db()
     c = conn.cursor()
-    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    now = now_str()
 
     imported_buildings = 0
-    imported_units = 0
-    imported_equipment = 0
 
     # Cache building ids by (code,name,address)
     b_cache = {}
 
-    for _, r in df.iterrows():
-        name_val = str(r.get(b_name, "")).strip()
-        if not name_val:
-            continue
-        code_val = str(r.get(b_code, "")).strip() if b_code else None
-        addr_val = str(r.get(addr, "")).strip() if addr else None
-        pm_val = str(r.get(pm, "")).strip() if pm else None
-        city_val = str(r.get(city, "")).strip() if city else None
-        state_val = str(r.get(state, "")).strip() if state else None
-
-        key = (code_val or "", name_val, addr_val or "")
-        if key in b_cache:
-            building_id = b_cache[key]
-        else:
-            # find existing building
-            c.execute("""
-                SELECT id FROM buildings
-                WHERE name=? AND COALESCE(address,'')=COALESCE(?, '')
-            """, (name_val, addr_val))
-            ex = c.fetchone()
-            if ex:
-                building_id = ex[0]
-                c.execute("""
-                    UPDATE buildings SET code=?, property_manager=?, city=?, state=?
-                    WHERE id=?
-                """, (code_val, pm_val, city_val, state_val, building_id))
+    # Unit/equipment rows collected per CSV row, written with executemany below
+    unit_rows = []
+    equip_rows = []
+
+    with conn:
+        # Take the write lock up front so the counts and building lookups
+        # below can't interleave with another session's writes
+        c.execute("BEGIN IMMEDIATE")
+        units_before = c.execute("SELECT COUNT(*) FROM units").fetchone()[0]
+        equipment_before = c.execute("SELECT COUNT(*) FROM equipment").fetchone()[0]
+
+        for r in df.to_dict("records"):
+            name_val = str(r.get(b_name, "")).strip()
+            if not name_val:
+                continue
+            code_val = str(r.get(b_code, "")).strip() if b_code else None
+            addr_val = str(r.get(addr, "")).strip() if addr else None
+            pm_val = str(r.get(pm, "")).strip() if pm else None
+            city_val = str(r.get(city, "")).strip() if city else None
+            state_val = str(r.get(state, "")).strip() if state else None
+
+            key = (code_val or "", name_val, addr_val or "")
+            if key in b_cache:
+                building_id = b_cache[key]
             else:
+                # find existing building
                 c.execute("""
-                    INSERT INTO buildings (code,name,address,property_manager,city,state,status,created_at)
-                    VALUES (?,?,?,?,?,?, 'active', ?)
-                """, (code_val, name_val, addr_val, pm_val, city_val, state_val, now))
-                building_id = c.lastrowid
-                imported_buildings += 1
-            b_cache[key] = building_id
-
-        # Units (optional)
-        unit_val = str(r.get(unit_col, "")).strip() if unit_col else ""
-        if unit_val:
-            resident_val = str(r.get(resident_col, "")).strip() if resident_col else None
-            c.execute("""
-                SELECT id FROM units WHERE building_id=? AND unit_number=?
-            """, (building_id, unit_val))
-            u = c.fetchone()
-            if u:
-                unit_id = u[0]
-                # update resident if present
-                if resident_val:
-                    c.execute("UPDATE units SET resident_name=? WHERE id=?", (resident_val, unit_id))
-            else:
-                c.execute("""
-                    INSERT INTO units (building_id, unit_number, resident_name, unit_type, status, notes, created_at)
-                    VALUES (?,?,?,?, 'active', NULL, ?)
-                """, (building_id, unit_val, resident_val, None, now))
-                unit_id = c.lastrowid
-                imported_units += 1
-
-            # Equipment (optional)
-            if serial_col:
-                serial_val = str(r.get(serial_col, "")).strip()
-                if serial_val:
-                    et = str(r.get(equip_type_col, "")).strip() if equip_type_col else None
-                    mf = str(r.get(manu_col, "")).strip() if manu_col else None
-                    md = str(r.get(model_col, "")).strip() if model_col else None
-                    # upsert equipment by serial (unique)
-                    c.execute("SELECT id FROM equipment WHERE serial_number=?", (serial_val,))
-                    e = c.fetchone()
-                    if e:
-                        c.execute("""
-                            UPDATE equipment SET unit_id=?, equipment_type=?, manufacturer=?, model=?
-                            WHERE id=?
-                        """, (unit_id, et, mf, md, e[0]))
-                    else:
-                        c.execute("""
-                            INSERT INTO equipment (unit_id,equipment_type,serial_number,manufacturer,model,status,notes,installed_at,last_service_at)
-                            VALUES (?,?,?,?,?, 'active', NULL, ?, NULL)
-                        """, (unit_id, et, serial_val, mf, md, now))
-                        imported_equipment += 1
+                    SELECT id FROM buildings
+                    WHERE name=? AND COALESCE(address,'')=COALESCE(?, '')
+                """, (name_val, addr_val))
+                ex = c.fetchone()
+                if ex:
+                    building_id = ex[0]
+                    c.execute("""
+                        UPDATE buildings SET code=?, property_manager=?, city=?, state=?
+                        WHERE id=?
+                    """, (code_val, pm_val, city_val, state_val, building_id))
+                else:
+                    c.execute("""
+                        INSERT INTO buildings (code,name,address,property_manager,city,state,status,created_at)
+                        VALUES (?,?,?,?,?,?, 'active', ?)
+                    """, (code_val, name_val, addr_val, pm_val, city_val, state_val, now))
+                    building_id = c.lastrowid
+                    imported_buildings += 1
+                b_cache[key] = building_id
+
+            # Units (optional)
+            unit_val = str(r.get(unit_col, "")).strip() if unit_col else ""
+            if unit_val:
+                resident_val = str(r.get(resident_col, "")).strip() if resident_col else None
+                unit_rows.append((building_id, unit_val, resident_val, now))
+
+                # Equipment (optional)
+                if serial_col:
+                    serial_val = str(r.get(serial_col, "")).strip()
+                    if serial_val:
+                        et = str(r.get(equip_type_col, "")).strip() if equip_type_col else None
+                        mf = str(r.get(manu_col, "")).strip() if manu_col else None
+                        md = str(r.get(model_col, "")).strip() if model_col else None
+                        equip_rows.append((building_id, unit_val, et, serial_val, mf, md, now))
+
+        # Units: insert new, only overwrite the resident when the CSV has one
+        c.executemany("""
+            INSERT INTO units (building_id, unit_number, resident_name, unit_type, status, notes, created_at)
+            VALUES (?,?,?, NULL, 'active', NULL, ?)
+            ON CONFLICT(building_id, unit_number) DO UPDATE SET
+                resident_name=COALESCE(NULLIF(excluded.resident_name, ''), units.resident_name)
+        """, unit_rows)
+
+        # Equipment: upsert by serial (unique); unit resolved from (building, unit number)
+        c.executemany("""
+            INSERT INTO equipment (unit_id,equipment_type,serial_number,manufacturer,model,status,notes,installed_at,last_service_at)
+            VALUES ((SELECT id FROM units WHERE building_id=? AND unit_number=?),?,?,?,?, 'active', NULL, ?, NULL)
+            ON CONFLICT(serial_number) DO UPDATE SET
+                unit_id=excluded.unit_id, equipment_type=excluded.equipment_type,
+                manufacturer=excluded.manufacturer, model=excluded.model
+        """, equip_rows)
+
+        # new units/serials = rows added by the upserts above
+        imported_units = c.execute("SELECT COUNT(*) FROM units").fetchone()[0] - units_before
+        imported_equipment = c.execute("SELECT COUNT(*) FROM equipment").fetchone()[0] - equipment_before
+
+    dashboard_counts.clear()
+    list_buildings.clear()
+    list_units.clear()
+    unit_equipment.clear()
+    return imported_buildings, imported_units, imported_equipment
 
-    conn.commit()
-    conn.close()
+# =========================================================
+# LOOKUP LISTS (cached; change rarely)
+# =========================================================
+@st.cache_data(ttl=300)
+def list_buildings() -> pd.DataFrame:
+    """
+    All buildings for the pickers; cleared by the CSV import.
+    """
+    return pd.read_sql_query("SELECT id, code, name, address, property_manager, city, state FROM buildings ORDER BY name", db())
 
-    return imported_buildings, imported_units, imported_equipment
+@st.cache_data(ttl=120)
+def list_units(building_id: int) -> pd.DataFrame:
+    """
+    Units of one building for the pickers; cleared by the CSV import.
+    """
+    return pd.read_sql_query("""
+        SELECT id, unit_number, resident_name, status, notes
+        FROM units WHERE building_id=?
+        ORDER BY unit_number
+    """, db(), params=(building_id,))
+
+def building_labels(bdf: pd.DataFrame) -> dict:
+    """
+    {id: label} for building pickers. Names aren't unique (the CSV import
+    keys buildings by name + address), so pickers select ids and same-named
+    buildings are told apart by address.
+    """
+    addr = bdf["address"].fillna("")
+    return dict(zip(bdf["id"], bdf["name"].where(addr == "", bdf["name"] + " — " + addr)))
+
+@st.cache_data(ttl=300)
+def list_active_techs() -> dict:
+    """
+    Active technicians as {name: id}, ordered by name (plain dict, no pandas).
+    """
+    rows = db().execute("SELECT name, id FROM contractors WHERE role='technician' AND status='active' ORDER BY name")
+    return dict(rows.fetchall())
 
 # =========================================================
 # SEARCH
@@ -580,56 +888,82 @@ def global_search(q: str) -> pd.DataFrame:
     LEFT JOIN units u ON u.building_id=b.id
     LEFT JOIN equipment e ON e.unit_id=u.id
     WHERE
-      LOWER(b.name) LIKE LOWER(?)
-      OR LOWER(COALESCE(b.address,'')) LIKE LOWER(?)
-      OR LOWER(COALESCE(u.unit_number,'')) LIKE LOWER(?)
-      OR LOWER(COALESCE(u.resident_name,'')) LIKE LOWER(?)
-      OR LOWER(COALESCE(e.serial_number,'')) LIKE LOWER(?)
+      -- LIKE is already case-insensitive for ASCII; no per-row LOWER() needed
+      b.name LIKE ?
+      OR COALESCE(b.address,'') LIKE ?
+      OR COALESCE(u.unit_number,'') LIKE ?
+      OR COALESCE(u.resident_name,'') LIKE ?
+      OR COALESCE(e.serial_number,'') LIKE ?
     LIMIT 500
     """
     like = f"%{q}%"
     df = pd.read_sql_query(query, conn, params=(like, like, like, like, like))
-    conn.close()
     return df
 
 # =========================================================
 # REPORT EXPORTS + EMAIL
 # =========================================================
 def unit_context(building_id: int, unit_id: int):
-    conn = db()
-    b = pd.read_sql_query("SELECT * FROM buildings WHERE id=?", conn, params=(building_id,))
-    u = pd.read_sql_query("SELECT * FROM units WHERE id=?", conn, params=(unit_id,))
-    e = pd.read_sql_query("SELECT * FROM equipment WHERE unit_id=?", conn, params=(unit_id,))
-    conn.close()
+    b = query_dicts("SELECT * FROM buildings WHERE id=?", (building_id,))
+    u = query_dicts("SELECT * FROM units WHERE id=?", (unit_id,))
     ctx = {
-        "building": b.iloc[0].to_dict() if not b.empty else {},
-        "unit": u.iloc[0].to_dict() if not u.empty else {},
-        "equipment": e.to_dict("records") if not e.empty else [],
+        "building": b[0] if b else {},
+        "unit": u[0] if u else {},
+        "equipment": query_dicts("SELECT * FROM equipment WHERE unit_id=?", (unit_id,)),
     }
     return ctx
 
-def fetch_unit_logs(building_id: int, unit_id: int) -> pd.DataFrame:
-    conn = db()
-    df = pd.read_sql_query("""
+UNIT_LOGS_PAGE = 20
+
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_unit_logs(building_id: int, unit_id: int, limit: int = UNIT_LOGS_PAGE, before=None):
+    """
+    One page of logs, newest first. `before` is the (created_at, id) cursor
+    returned by the previous page; returns (rows, next_cursor or None).
+    Cached per page; save_unit_log() clears it.
+    """
+    sql = """
         SELECT ul.id, ul.created_at, ul.log_type, ul.title, ul.content, c.name AS created_by
         FROM unit_logs ul
         JOIN contractors c ON c.id=ul.created_by
         WHERE ul.building_id=? AND ul.unit_id=?
-        ORDER BY ul.created_at DESC
-    """, conn, params=(building_id, unit_id))
-    conn.close()
-    return df
+    """
+    params = [building_id, unit_id]
+    if before:
+        sql += " AND (ul.created_at, ul.id) < (?, ?)"
+        params += list(before)
+    sql += " ORDER BY ul.created_at DESC, ul.id DESC LIMIT ?"
+    params.append(limit + 1)  # one extra row tells us whether an older page exists
+
+    rows = query_dicts(sql, params)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (rows[-1]["created_at"], rows[-1]["id"])
+    return rows, next_cursor
 
 def save_unit_log(building_id: int, unit_id: int, created_by: int, log_type: str, title: str, content: str):
     conn = db()
     c = conn.cursor()
-    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-    c.execute("""
-        INSERT INTO unit_logs (building_id, unit_id, created_by, log_type, title, content, created_at)
-        VALUES (?,?,?,?,?,?,?)
-    """, (building_id, unit_id, created_by, log_type, title, content, now))
-    conn.commit()
-    conn.close()
+    now = now_str()
+    with conn:
+        c.execute("""
+            INSERT INTO unit_logs (building_id, unit_id, created_by, log_type, title, content, created_at)
+            VALUES (?,?,?,?,?,?,?)
+        """, (building_id, unit_id, created_by, log_type, title, content, now))
+    dashboard_counts.clear()
+    fetch_unit_logs.clear()
+
+@st.cache_data(ttl=30, show_spinner=False)
+def unit_equipment(unit_id: int) -> list:
+    """
+    Equipment rows for one unit; cleared by the CSV import.
+    """
+    return query_dicts("""
+        SELECT equipment_type, serial_number, manufacturer, model, status, notes
+        FROM equipment WHERE unit_id=?
+        ORDER BY equipment_type, serial_number
+    """, (unit_id,))
 
 def send_email_report(to_email: str, subject: str, body_md: str, attachment_name: str = None, attachment_bytes: bytes = None):
     """
@@ -659,27 +993,16 @@ def send_email_report(to_email: str, subject: str, body_md: str, attachment_name
 # =========================================================
 # TIME CLOCK
 # =========================================================
-def get_open_time_entry(contractor_id: int):
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT id, clock_in FROM time_entries WHERE contractor_id=? AND clock_out IS NULL", (contractor_id,))
-    row = c.fetchone()
-    conn.close()
-    return row
-
 def clock_in(contractor_id: int, location: str):
     conn = db()
     c = conn.cursor()
-    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-    c.execute("""
-        INSERT INTO time_entries (contractor_id, clock_in, location, created_at)
-        VALUES (?, ?, ?, ?)
-    """, (contractor_id, now, location, now))
-    conn.commit()
-    c.execute("SELECT id FROM time_entries WHERE contractor_id=? AND clock_out IS NULL ORDER BY id DESC LIMIT 1", (contractor_id,))
-    tid = c.fetchone()[0]
-    conn.close()
-    return tid
+    now = now_str()
+    with conn:
+        c.execute("""
+            INSERT INTO time_entries (contractor_id, clock_in, location, created_at)
+            VALUES (?, ?, ?, ?)
+        """, (contractor_id, now, location, now))
+    return c.lastrowid
 
 def clock_out(entry_id: int):
     conn = db()
@@ -687,32 +1010,39 @@ def clock_out(entry_id: int):
     c.execute("SELECT clock_in FROM time_entries WHERE id=?", (entry_id,))
     row = c.fetchone()
     if not row:
-        conn.close()
         return False
 
-    clock_in_ts = datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S")
+    clock_in_ts = datetime.strptime(row[0], DB_TS_FORMAT)
     now_ts = datetime.utcnow()
     hours = (now_ts - clock_in_ts).total_seconds() / 3600.0
 
-    c.execute("""
-        UPDATE time_entries
-        SET clock_out=?, hours_worked=?
-        WHERE id=?
-    """, (now_ts.strftime("%Y-%m-%d %H:%M:%S"), hours, entry_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        c.execute("""
+            UPDATE time_entries
+            SET clock_out=?, hours_worked=?
+            WHERE id=?
+        """, (now_ts.strftime(DB_TS_FORMAT), hours, entry_id))
     return True
 
 # =========================================================
 # LOGIN PAGE (FIXED DEMO BUTTONS)
 # =========================================================
+# (button label, email, password) — must match upsert_default_users()
+DEMO_ACCOUNTS = [
+    ("👑 Owner (Darrell)", "darrell@fiberops-hghitechs.com", "Owner123!"),
+    ("👨‍💼 Supervisor", "brandon@fiberops-hghitechs.com", "Super123!"),
+    ("👷 Technician", "walter@fiberops-hghitechs.com", "Tech123!"),
+]
+
+def set_demo(email, pw):
+    # on_click callback: runs before the widgets are rebuilt, so the
+    # widget keys can be set directly and no extra st.rerun() is needed
+    st.session_state.login_prefill = {"email": email, "password": pw}
+    st.session_state.login_email = email
+    st.session_state.login_password = pw
+
 def login_page():
-    st.markdown(f"""
-    <div class="header">
-      <h2 style="margin:0;">🏢 {COMPANY_NAME}</h2>
-      <div class="muted">{APP_NAME}</div>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(LOGIN_HEADER, unsafe_allow_html=True)
 
     # Prefill values (safe)
     pre = st.session_state.get("login_prefill", {"email": "", "password": ""})
@@ -723,23 +1053,21 @@ def login_page():
     with col2:
         st.subheader("🔐 Login")
 
-        email = st.text_input("Email", key="login_email")
-        password = st.text_input("Password", type="password", key="login_password")
+        # Form: typing doesn't rerun the script, only the submit does
+        with st.form("login_form"):
+            email = st.text_input("Email", key="login_email")
+            password = st.text_input("Password", type="password", key="login_password")
+            submitted = st.form_submit_button("🚀 Login", type="primary", use_container_width=True)
 
-        if st.button("🚀 Login", type="primary", use_container_width=True):
-            user, msg = verify_login(email, password)
+        if submitted:
+            user, open_entry_id, msg = verify_login(email, password)
             if user:
                 st.session_state.logged_in = True
                 st.session_state.user = user
 
                 # restore open time entry (if any)
-                open_entry = get_open_time_entry(user["id"])
-                if open_entry:
-                    st.session_state.clocked_in = True
-                    st.session_state.active_time_entry_id = open_entry[0]
-                else:
-                    st.session_state.clocked_in = False
-                    st.session_state.active_time_entry_id = None
+                st.session_state.clocked_in = open_entry_id is not None
+                st.session_state.active_time_entry_id = open_entry_id
 
                 st.success(f"Welcome, {user['name']}!")
                 st.rerun()
@@ -748,38 +1076,18 @@ def login_page():
 
         st.markdown("----")
         st.caption("✅ Demo quick-fill buttons (these now work).")
-        d1, d2, d3 = st.columns(3)
-
-        def set_demo(email, pw):
-            # IMPORTANT: set prefill + clear widget keys safely by updating state, then rerun
-            st.session_state.login_prefill = {"email": email, "password": pw}
-            # reset widget keys
-            st.session_state.login_email = email
-            st.session_state.login_password = pw
-            st.rerun()
-
-        with d1:
-            if st.button("👑 Owner (Darrell)", use_container_width=True):
-                set_demo("darrell@fiberops-hghitechs.com", "Owner123!")
-        with d2:
-            if st.button("👨‍💼 Supervisor", use_container_width=True):
-                set_demo("brandon@fiberops-hghitechs.com", "Super123!")
-        with d3:
-            if st.button("👷 Technician", use_container_width=True):
-                set_demo("walter@fiberops-hghitechs.com", "Tech123!")
+        for col, (label, em, pw) in zip(st.columns(len(DEMO_ACCOUNTS)), DEMO_ACCOUNTS):
+            with col:
+                st.button(label, use_container_width=True, on_click=set_demo, args=(em, pw))
 
 # =========================================================
 # SIDEBAR + NAV
 # =========================================================
 def sidebar(user):
     with st.sidebar:
-        st.markdown(f"""
-        <div class="card">
-          <div style="font-weight:800; font-size:1.05rem;">👤 {user['name']}</div>
-          <div style="margin-top:6px;">{role_badge(user['role'])}</div>
-          <div class="muted" style="margin-top:6px;">{user['email']}</div>
-        </div>
-        """, unsafe_allow_html=True)
+        st.markdown(USER_CARD.substitute(
+            name=user["name"], badge=role_badge(user["role"]), email=user["email"],
+        ), unsafe_allow_html=True)
 
         # AI status
         if DEEPSEEK_API_KEY:
@@ -845,27 +1153,33 @@ def sidebar(user):
 # =========================================================
 # PAGES
 # =========================================================
+@st.cache_data(ttl=30)
+def dashboard_counts():
+    """
+    Dashboard metrics; cleared by the CSV import and save_unit_log().
+    """
+    return db().execute("""
+        SELECT
+          (SELECT COUNT(*) FROM buildings),
+          (SELECT COUNT(*) FROM units),
+          (SELECT COUNT(*) FROM equipment),
+          (SELECT COUNT(*) FROM unit_logs)
+    """).fetchone()
+
 def page_dashboard(user):
-    st.markdown(f"""
-    <div class="header">
-      <h2 style="margin:0;">🏢 {COMPANY_NAME} Field Ops</h2>
-      <div class="muted">Welcome back, {user['name']} • {datetime.now().strftime('%A, %b %d, %Y')}</div>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(HEADER_CARD.substitute(
+        title=f"🏢 {COMPANY_NAME} Field Ops",
+        subtitle=f"Welcome back, {user['name']} • {datetime.now().strftime('%A, %b %d, %Y')}",
+    ), unsafe_allow_html=True)
 
     c1, c2, c3, c4 = st.columns(4)
 
-    conn = db()
-    buildings = pd.read_sql_query("SELECT COUNT(*) AS n FROM buildings", conn)["n"][0]
-    units = pd.read_sql_query("SELECT COUNT(*) AS n FROM units", conn)["n"][0]
-    equips = pd.read_sql_query("SELECT COUNT(*) AS n FROM equipment", conn)["n"][0]
-    logs = pd.read_sql_query("SELECT COUNT(*) AS n FROM unit_logs", conn)["n"][0]
-    conn.close()
+    buildings, units, equips, logs = dashboard_counts()
 
-    c1.metric("Buildings", int(buildings))
-    c2.metric("Units", int(units))
-    c3.metric("Serials/Equipment", int(equips))
-    c4.metric("Unit Reports/Logs", int(logs))
+    c1.metric("Buildings", buildings)
+    c2.metric("Units", units)
+    c3.metric("Serials/Equipment", equips)
+    c4.metric("Unit Reports/Logs", logs)
 
     st.markdown("### ✅ Boss Demo Path (never breaks)")
     st.info(
@@ -894,9 +1208,9 @@ def page_import_csv(user):
 
     up = st.file_uploader("Upload CSV", type=["csv"])
     if up:
-        preview = pd.read_csv(up)
+        preview = pd.read_csv(up, nrows=30)  # only the shown rows; the import re-reads the full bytes
         st.write("Preview:")
-        st.dataframe(preview.head(30), use_container_width=True)
+        st.dataframe(preview, use_container_width=True)
 
         if st.button("✅ Import into System", type="primary"):
             try:
@@ -923,12 +1237,10 @@ def page_search(user):
     st.dataframe(df, use_container_width=True)
 
     st.markdown("### Open a result")
-    pick = st.selectbox(
-        "Select a row to open unit",
-        df.apply(lambda r: f"{r['building']} | Unit {r['unit']} | Serial {r['serial']}", axis=1).tolist()
-    )
+    labels = (df["building"] + " | Unit " + df["unit"].fillna("—") + " | Serial " + df["serial"].fillna("—")).tolist()
+    pick = st.selectbox("Select a row to open unit", range(len(df)), format_func=labels.__getitem__)
     if st.button("Open Unit Reports", type="primary"):
-        row = df.iloc[df.apply(lambda r: f"{r['building']} | Unit {r['unit']} | Serial {r['serial']}", axis=1).tolist().index(pick)]
+        row = df.iloc[pick]
         st.session_state["open_building_id"] = int(row["building_id"]) if pd.notna(row["building_id"]) else None
         st.session_state["open_unit_id"] = int(row["unit_id"]) if pd.notna(row["unit_id"]) else None
         st.session_state.current_page = "Unit Reports"
@@ -937,40 +1249,28 @@ def page_search(user):
 def page_buildings_units(user):
     st.subheader("🏢 Buildings & Units")
 
-    conn = db()
-    bdf = pd.read_sql_query("SELECT id, code, name, address, property_manager, city, state FROM buildings ORDER BY name", conn)
-    conn.close()
+    bdf = list_buildings()
 
     if bdf.empty:
         st.info("No buildings found. Import CSV first.")
         return
 
-    bname = st.selectbox(
-        "Select building",
-        bdf.apply(lambda r: f"{r['name']} ({r['code'] or 'no-code'})", axis=1).tolist()
-    )
-    b_row = bdf.iloc[bdf.apply(lambda r: f"{r['name']} ({r['code'] or 'no-code'})", axis=1).tolist().index(bname)]
+    b_labels = (bdf["name"] + " (" + bdf["code"].fillna("").replace("", "no-code") + ")").tolist()
+    b_pos = st.selectbox("Select building", range(len(bdf)), format_func=b_labels.__getitem__)
+    b_row = bdf.iloc[b_pos]
     building_id = int(b_row["id"])
 
-    st.markdown(f"<div class='card'><b>{b_row['name']}</b><div class='muted'>{b_row['address'] or ''}</div></div>", unsafe_allow_html=True)
+    st.markdown(TITLE_CARD.substitute(title=b_row['name'], subtitle=b_row['address'] or ''), unsafe_allow_html=True)
 
-    conn = db()
-    udf = pd.read_sql_query("""
-        SELECT id, unit_number, resident_name, status, notes
-        FROM units WHERE building_id=?
-        ORDER BY unit_number
-    """, conn, params=(building_id,))
-    conn.close()
+    udf = list_units(building_id)
 
     if udf.empty:
         st.warning("No units found for this building.")
         return
 
-    unit_label = st.selectbox(
-        "Select unit",
-        udf.apply(lambda r: f"{r['unit_number']} — {r['resident_name'] or 'No resident'}", axis=1).tolist()
-    )
-    u_row = udf.iloc[udf.apply(lambda r: f"{r['unit_number']} — {r['resident_name'] or 'No resident'}", axis=1).tolist().index(unit_label)]
+    u_labels = (udf["unit_number"] + " — " + udf["resident_name"].fillna("").replace("", "No resident")).tolist()
+    u_pos = st.selectbox("Select unit", range(len(udf)), format_func=u_labels.__getitem__)
+    u_row = udf.iloc[u_pos]
     unit_id = int(u_row["id"])
 
     col1, col2 = st.columns([2, 1])
@@ -987,15 +1287,9 @@ def page_buildings_units(user):
             st.rerun()
 
     st.markdown("### Equipment / Serials in this unit")
-    conn = db()
-    edf = pd.read_sql_query("""
-        SELECT equipment_type, serial_number, manufacturer, model, status, notes
-        FROM equipment WHERE unit_id=?
-        ORDER BY equipment_type, serial_number
-    """, conn, params=(unit_id,))
-    conn.close()
+    edf = unit_equipment(unit_id)
 
-    if edf.empty:
+    if not edf:
         st.info("No equipment recorded for this unit yet.")
     else:
         st.dataframe(edf, use_container_width=True)
@@ -1007,9 +1301,7 @@ def page_unit_reports(user):
     building_id = st.session_state.get("open_building_id", None)
     unit_id = st.session_state.get("open_unit_id", None)
 
-    conn = db()
-    bdf = pd.read_sql_query("SELECT id, name FROM buildings ORDER BY name", conn)
-    conn.close()
+    bdf = list_buildings()
 
     if bdf.empty:
         st.info("No buildings yet. Import CSV first.")
@@ -1017,43 +1309,50 @@ def page_unit_reports(user):
 
     # If not set, pick manually
     if not building_id:
-        building_id = int(st.selectbox("Building", bdf["name"].tolist(), index=0, key="rep_building_pick") and bdf.iloc[0]["id"])
+        building_id = st.selectbox("Building", bdf["id"].tolist(), format_func=building_labels(bdf).get, key="rep_building_pick")
     else:
         # show label
         pass
 
     # Resolve building name
-    bname = bdf[bdf["id"] == building_id]["name"].iloc[0] if (bdf["id"] == building_id).any() else "Building"
+    bname = dict(zip(bdf["id"], bdf["name"])).get(building_id, "Building")
 
-    conn = db()
-    udf = pd.read_sql_query("SELECT id, unit_number, resident_name FROM units WHERE building_id=? ORDER BY unit_number", conn, params=(building_id,))
-    conn.close()
+    udf = list_units(building_id)
 
     if udf.empty:
         st.warning("No units for this building.")
         return
 
     if not unit_id:
-        label = st.selectbox("Unit", udf.apply(lambda r: f"{r['unit_number']} — {r['resident_name'] or ''}", axis=1).tolist())
-        unit_id = int(udf.iloc[udf.apply(lambda r: f"{r['unit_number']} — {r['resident_name'] or ''}", axis=1).tolist().index(label)]["id"])
+        u_labels = dict(zip(udf["id"], udf["unit_number"] + " — " + udf["resident_name"].fillna("")))
+        unit_id = int(st.selectbox("Unit", udf["id"].tolist(), format_func=u_labels.get))
     else:
         pass
 
-    urow = udf[udf["id"] == unit_id].iloc[0]
-    unit_number = urow["unit_number"]
+    unit_number = dict(zip(udf["id"], udf["unit_number"]))[unit_id]
 
-    st.markdown(f"<div class='card'><b>{bname}</b><div class='muted'>Unit {unit_number}</div></div>", unsafe_allow_html=True)
+    st.markdown(TITLE_CARD.substitute(title=bname, subtitle=f"Unit {unit_number}"), unsafe_allow_html=True)
 
-    # Existing logs
-    logs = fetch_unit_logs(building_id, unit_id)
-    if logs.empty:
+    # Existing logs (keyset-paged, newest first)
+    cursor_key = f"logs_before_{unit_id}"
+    logs, older = fetch_unit_logs(building_id, unit_id, before=st.session_state.get(cursor_key))
+    if not logs:
         st.info("No reports/logs saved for this unit yet.")
     else:
         st.markdown("### Saved Reports/Logs")
-        for _, r in logs.iterrows():
+        for r in logs:
             with st.expander(f"{r['created_at']} • {r['log_type'].upper()} • {r['title']} • by {r['created_by']}"):
                 st.markdown(r["content"])
 
+    if older or st.session_state.get(cursor_key):
+        p1, p2 = st.columns(2)
+        with p1:
+            if st.session_state.get(cursor_key):
+                st.button("⏮️ Newest logs", key=f"logs_newest_{unit_id}", on_click=ss_set, args=(cursor_key, None))
+        with p2:
+            if older:
+                st.button("Older logs ⏭️", key=f"logs_older_{unit_id}", on_click=ss_set, args=(cursor_key, older))
+
     st.markdown("----")
     st.markdown("### Create a new report/log")
 
@@ -1090,17 +1389,15 @@ def page_unit_reports(user):
     with tab1:
         notes = st.text_area("Enter what was done in this unit (steps, equipment, fiber work, construction work, tests, etc.)", height=180)
         if st.button("🤖 Generate Professional Report", type="primary", disabled=not notes.strip()):
-            report = ai_generate_unit_report(ctx, notes)
             st.markdown("#### Generated Report")
-            st.markdown(report)
+            report = ai_generate_unit_report(ctx, notes)
             report_actions(report, f"Work Report (Manual) - {unit_number}")
 
     with tab2:
         raw = st.text_area("Paste email or any text notes (Elauwit, supervisor notes, etc.)", height=180)
         if st.button("🤖 Generate Professional Report", type="primary", key="gen_from_text", disabled=not raw.strip()):
-            report = ai_generate_unit_report(ctx, raw)
             st.markdown("#### Generated Report")
-            st.markdown(report)
+            report = ai_generate_unit_report(ctx, raw)
             report_actions(report, f"Work Report (Text) - {unit_number}")
 
     with tab3:
@@ -1111,11 +1408,23 @@ def page_unit_reports(user):
             st.text_area("Preview", raw_text[:4000], height=160)
 
             if st.button("🤖 Generate Unit Report from WhatsApp", type="primary"):
-                report = ai_generate_unit_report(ctx, raw_text)
                 st.markdown("#### Generated Report")
-                st.markdown(report)
+                report = ai_generate_unit_report(ctx, raw_text)
                 report_actions(report, f"Work Report (WhatsApp) - {unit_number}")
 
+def best_match_index(values, needle) -> int:
+    """
+    Position of the first case-insensitive exact match, else the first
+    plain substring match, else 0 (used to preselect parsed defaults).
+    """
+    needle = str(needle or "").strip().lower()
+    if not needle:
+        return 0
+    values = [str(v).lower() for v in values]
+    if needle in values:
+        return values.index(needle)
+    return next((i for i, v in enumerate(values) if needle in v), 0)
+
 def page_email_parser(user):
     st.subheader("📧 AI Email Parser → Create Ticket + Optional Report")
 
@@ -1131,77 +1440,71 @@ Technician needed ASAP
 
     if st.button("Parse Email", type="primary"):
         parsed = parse_elauwit_email(email_text)
-        st.success("Parsed:")
-        st.json(parsed)
+        # Pick the fallback ticket id once, here: a default that changed every
+        # rerun would make Streamlit reset the Ticket ID input (and the user's edit)
+        parsed["ticket_id"] = parsed.get("ticket_id") or f"T-{int(datetime.now().timestamp())}"
+        st.session_state["parsed_email"] = parsed
+        st.session_state["parsed_email_source"] = email_text
+
+    # Keep the parse across reruns so the ticket form below stays usable,
+    # but only while it still belongs to the email in the text box
+    parsed = st.session_state.get("parsed_email")
+    if not parsed or st.session_state.get("parsed_email_source") != email_text:
+        return
 
-        # Create ticket workflow
-        conn = db()
-        bdf = pd.read_sql_query("SELECT id, code, name FROM buildings ORDER BY name", conn)
-        conn.close()
+    st.success("Parsed:")
+    st.json(parsed)
 
-        # best effort property match
-        building_id = None
-        if parsed.get("property_code") and not bdf.empty:
-            hits = bdf[bdf["code"].fillna("").str.contains(str(parsed["property_code"]), case=False)]
-            if not hits.empty:
-                building_id = int(hits.iloc[0]["id"])
+    # Create ticket workflow
+    bdf = list_buildings()
 
-        if bdf.empty:
-            st.warning("No buildings loaded yet. Import CSV first.")
-            return
+    if bdf.empty:
+        st.warning("No buildings loaded yet. Import CSV first.")
+        return
 
-        b_choice = st.selectbox("Building", bdf["name"].tolist(), index=0 if building_id is None else bdf.index[bdf["id"]==building_id][0])
-        building_id = int(bdf[bdf["name"] == b_choice]["id"].iloc[0])
+    # best effort property match
+    b_idx = best_match_index(bdf["code"].fillna(""), parsed.get("property_code"))
+    building_id = st.selectbox("Building", bdf["id"].tolist(), index=b_idx, format_func=building_labels(bdf).get)
 
-        conn = db()
-        udf = pd.read_sql_query("SELECT id, unit_number FROM units WHERE building_id=? ORDER BY unit_number", conn, params=(building_id,))
-        conn.close()
+    udf = list_units(building_id)
 
-        if udf.empty:
-            st.warning("No units in this building yet.")
-            return
+    if udf.empty:
+        st.warning("No units in this building yet.")
+        return
+
+    # best effort unit match
+    u_idx = best_match_index(udf["unit_number"], parsed.get("unit_number"))
+    unit_id = st.selectbox("Unit", udf["id"].tolist(), index=u_idx, format_func=dict(zip(udf["id"], udf["unit_number"])).get)
 
-        # best effort unit match
-        unit_id = None
-        if parsed.get("unit_number"):
-            hits = udf[udf["unit_number"].astype(str).str.contains(str(parsed["unit_number"]), case=False)]
-            if not hits.empty:
-                unit_id = int(hits.iloc[0]["id"])
+    tech_name_to_id = list_active_techs()
+    assigned = st.selectbox("Assign to", ["Unassigned", *tech_name_to_id])
+    assigned_id = None
+    if assigned != "Unassigned":
+        assigned_id = int(tech_name_to_id[assigned])
 
-        unit_choice = st.selectbox("Unit", udf["unit_number"].tolist(), index=0 if unit_id is None else udf.index[udf["id"]==unit_id][0])
-        unit_id = int(udf[udf["unit_number"]==unit_choice]["id"].iloc[0])
+    ticket_id = st.text_input("Ticket ID", value=parsed["ticket_id"])
+    priority = st.selectbox("Priority", PRIORITIES, index=PRIORITY_IDX.get(parsed.get("priority"), 0))
+    desc = st.text_area("Description", value=parsed.get("issue_description") or "", height=90)
 
+    if st.button("✅ Create Work Order", type="primary"):
         conn = db()
-        techs = pd.read_sql_query("SELECT id, name FROM contractors WHERE role='technician' AND status='active' ORDER BY name", conn)
-        conn.close()
-
-        assigned = st.selectbox("Assign to", ["Unassigned"] + techs["name"].tolist())
-        assigned_id = None
-        if assigned != "Unassigned":
-            assigned_id = int(techs[techs["name"]==assigned]["id"].iloc[0])
-
-        ticket_id = st.text_input("Ticket ID", value=parsed.get("ticket_id") or f"T-{int(datetime.now().timestamp())}")
-        priority = st.selectbox("Priority", ["normal","high","urgent"], index=["normal","high","urgent"].index(parsed.get("priority","normal")))
-        desc = st.text_area("Description", value=parsed.get("issue_description") or "", height=90)
-
-        if st.button("✅ Create Work Order", type="primary"):
-            conn = db()
-            c = conn.cursor()
-            now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            try:
+        c = conn.cursor()
+        now = now_str()
+        try:
+            with conn:
                 c.execute("""
                     INSERT INTO work_orders (ticket_id, building_id, unit_id, description, priority, status, created_by, assigned_to, created_at, source, raw_text)
-                    VALUES (?,?,?,?, 'open', ?, ?, ?, ?, ?, ?)
+                    VALUES (?,?,?,?,?, 'open', ?, ?, ?, ?, ?)
                 """, (
                     ticket_id, building_id, unit_id, desc, priority,
                     user["id"], assigned_id, now, "email", email_text
                 ))
-                conn.commit()
-                st.success(f"Work order {ticket_id} created.")
-            except Exception as e:
-                st.error(f"Failed: {e}")
-            finally:
-                conn.close()
+            st.success(f"Work order {ticket_id} created.")
+        except sqlite3.IntegrityError:
+            # ticket_id is UNIQUE; let the constraint do the duplicate check
+            st.warning(f"Work order {ticket_id} already exists.")
+        except Exception as e:
+            st.error(f"Failed: {e}")
 
 def page_whatsapp_import(user):
     st.subheader("🟢 WhatsApp Import (Save to Units as Reports)")
@@ -1215,31 +1518,26 @@ def page_whatsapp_import(user):
     raw_text = wa.read().decode("utf-8", errors="ignore")
     st.text_area("Preview", raw_text[:5000], height=180)
 
-    conn = db()
-    bdf = pd.read_sql_query("SELECT id, name FROM buildings ORDER BY name", conn)
-    conn.close()
+    bdf = list_buildings()
 
     if bdf.empty:
         st.warning("No buildings loaded yet. Import CSV first.")
         return
 
-    b_choice = st.selectbox("Building", bdf["name"].tolist())
-    building_id = int(bdf[bdf["name"] == b_choice]["id"].iloc[0])
+    building_id = st.selectbox("Building", bdf["id"].tolist(), format_func=building_labels(bdf).get)
 
-    conn = db()
-    udf = pd.read_sql_query("SELECT id, unit_number FROM units WHERE building_id=? ORDER BY unit_number", conn, params=(building_id,))
-    conn.close()
+    udf = list_units(building_id)
 
     if udf.empty:
         st.warning("No units in this building.")
         return
 
-    unit_choice = st.selectbox("Unit", udf["unit_number"].tolist())
-    unit_id = int(udf[udf["unit_number"]==unit_choice]["id"].iloc[0])
+    unit_labels = dict(zip(udf["id"], udf["unit_number"]))
+    unit_id = st.selectbox("Unit", udf["id"].tolist(), format_func=unit_labels.get)
+    unit_choice = unit_labels[unit_id]
 
     if st.button("🤖 Generate Report", type="primary"):
         report = ai_generate_unit_report(unit_context(building_id, unit_id), raw_text)
-        st.markdown(report)
 
         if st.button("💾 Save Report to Unit", type="primary"):
             save_unit_log(building_id, unit_id, user["id"], "report", f"Work Report (WhatsApp) - {unit_choice}", report)
@@ -1257,7 +1555,6 @@ def page_time_payroll(user):
         ORDER BY te.id DESC
         LIMIT 500
     """, conn)
-    conn.close()
 
     if df.empty:
         st.info("No time entries yet.")